@@ -35,13 +35,27 @@
 # -------------------------
 
 # import modules
+from functools import lru_cache
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from scipy.stats import binom
+# compiled kernels for the American backward induction
+try:
+    from BinomialKernels import amer_backward, price_all_amer # compiled by numba when first used - price_all_amer uses all cores
+except ImportError:
+    # without numba, use the ahead-of-time compiled extension built by running BinomialKernels.py (runs on one core)
+    from binom_kernel import amer_backward, price_all_amer
+
+# Option types are passed to the compiled code as integer codes rather than strings.
+OPTION_CODES = {"call": 0, "put": 1, "cash_or_nothing_call": 2, "cash_or_nothing_put": 3}
 
 # Based on a p=0.5 binomial method.
 # Calculate tree variables u and d
 # These are the change in stock price with each step.
+# The same (r, sigma, T, steps) are used for thousands of pricings, so results are cached.
 
+@lru_cache(maxsize=32)
 def find_dt_u_d(r, sigma, T, steps):
     dt = T/steps
     A = np.exp((sigma**2)*dt) - 1
@@ -50,17 +64,33 @@ def find_dt_u_d(r, sigma, T, steps):
     d = B*(1-np.sqrt(A))
     return dt, u, d
 
+# Powers of u and d, and the terminal stock prices per unit S_0 (u**j * d**(steps-j)).
+# Cached by (r, sigma, T, steps) - callers multiply by S_0 when they use them.
+_terminal_cache = {}
+
+def find_tree_powers(r, sigma, T, steps):
+    key = (r, sigma, T, steps)
+    if key not in _terminal_cache:
+        dt, u, d = find_dt_u_d(r, sigma, T, steps)
+        upow = np.power(u, np.arange(steps+1))
+        dpow = np.power(d, np.arange(steps+1))
+        S_T_factor = upow*dpow[::-1]
+        for arr in (upow, dpow, S_T_factor):
+            arr.flags.writeable = False # shared between callers
+        _terminal_cache[key] = (upow, dpow, S_T_factor)
+    return _terminal_cache[key]
+
 # For a given time, steps - produce a tree of possible stock prices.
 # Specify S_0, r, sigma, T, steps
+# Row i of the returned array holds the i+1 prices S_0*u**j*d**(i-j) in tree[i, :i+1] (the rest is zero).
+# This is a utility for plotting and debugging only - the pricers never build the full O(steps^2) tree:
+# the European pricer needs just the terminal row, and the American kernel steps through prices level by level.
 def produce_tree(S_0, r, sigma, T, steps):
-    dt, u, d = find_dt_u_d(r, sigma, T, steps)
-    tree = []
-    for i in range(steps+1):
-        row = []
-        for j in range(i+1):
-            value = S_0*(u**j)*(d**(i-j))
-            row.append(value)
-        tree.append(row)
+    upow, dpow, S_T_factor = find_tree_powers(r, sigma, T, steps)
+    j = np.arange(steps+1)
+    i = j[:, None]
+    tree = S_0*upow[None, :]*dpow[np.maximum(i-j, 0)] # broadcast over (i, j)
+    tree[j > i] = 0.0 # only j <= i is part of the tree
     return tree
 
 # A function that runs a load of bernoulli trials on calculated u and d values
@@ -77,24 +107,20 @@ def plot_stock_sample(S_0, r, sigma, T, steps, trials):
     subplot_title = r"$r = $" + str(r) + r", $\sigma = $" + str(sigma) + ", " + str(steps) + " steps"
     axs_1.set_title(subplot_title)
 
-    for j in range(trials):
-        S = [S_0]
-        t = [0.0]
-        
-        S_now = S_0
-        t_0 = 0.0
-        for i in range(steps):
-            rand = np.random.random()
-            if rand < 0.5:
-                S_now *= u
-            else:
-                S_now *= d
-            t_0 += dt
-            S_plot = S_now + (S_now*np.random.normal(0, 0.015)) # plotting with a tiny variation shows distribution more easily.
-            S.append(S_plot)
-            t.append(t_0)
-        
-        axs_1.plot(t, S, c='k', lw=0.1, alpha=0.8)
+    # draw every up/down move for every trial at once, then build the paths with a cumulative product
+    rng = np.random.default_rng()
+    moves = np.where(rng.random((trials, steps)) < 0.5, u, d)
+    S = np.empty((trials, steps+1))
+    S[:, 0] = S_0
+    S[:, 1:] = S_0*np.cumprod(moves, axis=1)
+    S[:, 1:] += S[:, 1:]*rng.normal(0, 0.015, (trials, steps)) # plotting with a tiny variation shows distribution more easily.
+    t = dt*np.arange(steps+1)
+
+    # all paths go into one LineCollection - a single artist rather than one Line2D per trial
+    segments = np.stack([np.broadcast_to(t, (trials, steps+1)), S], axis=-1)
+    lines = LineCollection(segments, colors='k', linewidths=0.1, alpha=0.8)
+    axs_1.add_collection(lines)
+    axs_1.autoscale()
     
     axs_1.set_xlabel("Time")
     axs_1.set_ylabel("Stock Price")
@@ -103,86 +129,83 @@ def plot_stock_sample(S_0, r, sigma, T, steps, trials):
 
 # Define a payoff function.
 # types of options are "call", "put", "cash_or_nothing_call", "cash_or_nothing_put"
+# Each payoff works on a single stock price or a whole array of them - look one up once, then apply it to arrays.
+PAYOFF_FNS = {
+    "call": lambda S, E: np.maximum(S-E, 0.0),
+    "put": lambda S, E: np.maximum(E-S, 0.0),
+    "cash_or_nothing_call": lambda S, E: 10.0*(S > E),
+    "cash_or_nothing_put": lambda S, E: 10.0*(E > S),
+}
+
 def payoff(S, E, option_type): # S = Stock Price, E = Exercise Price.
-    if option_type == "call":
-        if (S-E) > 0:
-            payoff = S-E
-        else:
-            payoff = 0
-        return payoff
-    elif option_type == "put":
-        if (E-S) > 0:
-            payoff = E-S
-        else:
-            payoff = 0
-        return payoff
-    elif option_type == "cash_or_nothing_call":
-        if (S-E) > 0:
-            payoff = 10
-        else:
-            payoff = 0
-        return payoff
-    elif option_type == "cash_or_nothing_put":
-        if (E-S) > 0:
-            payoff = 10
-        else:
-            payoff = 0
-        return payoff
+    return PAYOFF_FNS[option_type](S, E)
+
+# The probability of finishing at each terminal node - C(n,j) * 2^-n for j = 0..n.
+# binom.pmf works in log space, so there is no overflow of C(n,j) for large n.
+@lru_cache(maxsize=32)
+def find_binomial_weights(steps):
+    w = binom.pmf(np.arange(steps+1), steps, 0.5)
+    w.flags.writeable = False # shared between callers
+    return w
 
 # find the price of a European option.
+# With p = 0.5 the backward induction collapses to a binomial sum over the terminal prices:
+# V = exp(-r*T) * sum_j C(n,j) * 2^-n * payoff(S_0*u**j*d**(n-j))
+# S_0 may be a single price or an array of prices - all are priced in one call.
 def find_euro_option_value(S_0, r, sigma, T, steps, E, option_type):
-    dt, u, d = find_dt_u_d(r, sigma, T, steps)
-    tree = produce_tree(S_0, r, sigma, T, steps)
-    tree_len = len(tree)
-    final_row = tree[tree_len-1]
-    payoff_row = []
-    for value in final_row:
-        pay_value = payoff(value, E, option_type)
-        payoff_row.append(pay_value)
-    discount = np.exp(-r*dt)
-    
-    for i in range(steps):
-        new_row = []
-        for j in range(len(payoff_row)-1):
-            new_value = discount*(0.5)*(payoff_row[j]+payoff_row[j+1])
-            new_row.append(new_value)
-        payoff_row = new_row
-    euro_option_value = payoff_row[0]
+    upow, dpow, S_T_factor = find_tree_powers(r, sigma, T, steps)
+    w = find_binomial_weights(steps)
+    S_T = np.multiply.outer(S_0, S_T_factor) # terminal prices, shape (len(S_0), steps+1)
+    payoff_row = PAYOFF_FNS[option_type](S_T, E)
+    euro_option_value = np.exp(-r*T)*(payoff_row @ w)
     return euro_option_value
 
 
 # find the price of a American option.
+# Also returns whether early exercise is optimal at the current time.
+# For many S_0 values use find_option_values_batch, which returns this as a boolean array.
 def find_amer_option_value(S_0, r, sigma, T, steps, E, option_type):
     dt, u, d = find_dt_u_d(r, sigma, T, steps)
-    tree = produce_tree(S_0, r, sigma, T, steps)
-    tree_len = len(tree)
-    final_row = tree[tree_len-1]
-    payoff_row = []
-    for value in final_row:
-        pay_value = payoff(value, E, option_type)
-        payoff_row.append(pay_value)
+    upow, dpow, S_T_factor = find_tree_powers(r, sigma, T, steps)
+    payoff_row = PAYOFF_FNS[option_type](S_0*S_T_factor, E) # terminal row only - no need for the full tree
     discount = np.exp(-r*dt)
-    
-    s_f_list = []
-
-    for i in range(steps):
-        tree_row = tree[(tree_len-2)-i]
-        new_row = []
-        for j in range(len(payoff_row)-1):
-            hold_value = discount*(0.5)*(payoff_row[j]+payoff_row[j+1])
-            tree_value = tree_row[j]
-            exercise_value = payoff(tree_value, E, option_type)
-            if exercise_value>hold_value:
-                exercise=True
-            else:
-                exercise=False
-            new_value = max(hold_value, exercise_value)
-            new_row.append(new_value)
-        payoff_row = new_row
-    amer_option_value = payoff_row[0]
+    amer_option_value, exercise = amer_backward(payoff_row, float(S_0), u, d, dpow, float(E), OPTION_CODES[option_type], discount, steps)
     return amer_option_value, exercise
+
+
+# find the price of European and American options for a whole array of initial stock prices at once.
+# dt, u and d don't depend on S_0, so they are found once and S_0 becomes an extra array axis.
+# Returns arrays of European values, American values, and whether early exercise is optimal now (for each S_0).
+def find_option_values_batch(S_0_arr, r, sigma, T, steps, E, option_type):
+    S_0_arr = np.asarray(S_0_arr, dtype=float)
+    dt, u, d = find_dt_u_d(r, sigma, T, steps)
+    discount = np.exp(-r*dt)
+
+    V_E = find_euro_option_value(S_0_arr, r, sigma, T, steps, E, option_type)
+
+    # the American backward inductions for different S_0 are independent - run them in parallel
+    upow, dpow, S_T_factor = find_tree_powers(r, sigma, T, steps)
+    V_A, exercise = price_all_amer(S_0_arr, u, d, dpow, S_T_factor, float(E), OPTION_CODES[option_type], discount, steps)
+    return V_E, V_A, exercise
         
 
+# Plot European and American option values against S_0 on one set of axes.
+# The American option is drawn dashed wherever early exercise is optimal.
+def plot_panel(ax, S_0_arr, V_E, V_A, exercise, T, text_x=0.05):
+    #plot euro option
+    ax.plot(S_0_arr, V_E, c='b', label="European Option")
+
+    # plot american option
+    ax.plot(S_0_arr[~exercise], V_A[~exercise], c='r', label = "American Option (Held)")
+    if exercise.any():
+        ax.plot(S_0_arr[exercise], V_A[exercise], '--', c='r', label = "American Option (Exercised)")
+
+    t_title = str(T)
+    title_string = "t = " + t_title
+    ax.text(text_x, .7,title_string,
+            transform=ax.transAxes, fontsize=10)
+
+
 if __name__ == "__main__":
     # Specify some parameters of interest
     r = 0.20 # interest rate
@@ -213,297 +236,14 @@ if __name__ == "__main__":
 
     title_string = "Vales of Options Calculated Using a Binomial Method - " + r"$r = $" + str(r) + r", $\sigma = $" + str(sigma) + r", $E = $" + str(E)
     fig_2.suptitle(title_string)
-    # Calls first
-    option_type = "call" # types are "call", "put", "cash_or_nothing_call", "cash_or_nothing_put"
-
-    # Increment through timesteps
-    T = 10 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    #plot euro option
-    axs_2[0][0].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[0][0].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[0][0].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-    
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[0][0].text(0.05, .7,title_string,
-            transform=axs_2[0][0].transAxes, fontsize=10)
-    
-
-    ## Timestep 2
-    T = 5 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    #plot euro option
-    axs_2[1][0].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[1][0].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[1][0].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-    
-    
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[1][0].text(0.05, .7,title_string,
-            transform=axs_2[1][0].transAxes, fontsize=10)
-
-    ## Timestep 3
-    T = 2 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    #plot euro option
-    axs_2[2][0].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[2][0].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[2][0].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-    
-    
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[2][0].text(0.05, .7,title_string,
-            transform=axs_2[2][0].transAxes, fontsize=10)
-    
-    ## Timestep 4
-    T = 0 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    #plot euro option
-    axs_2[3][0].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[3][0].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[3][0].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-    
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[3][0].text(0.05, .7,title_string,
-            transform=axs_2[3][0].transAxes, fontsize=10)
-
-    # Now with Puts
-    # Calls first
-    option_type = "put" # types are "call", "put", "cash_or_nothing_call", "cash_or_nothing_put"
-
-    # Increment through timesteps
-    T = 10 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[0][1].text(0.25, .7,title_string,
-            transform=axs_2[0][1].transAxes, fontsize=10)
-
-    #plot euro option
-    axs_2[0][1].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[0][1].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[0][1].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-        if option_type == "put":
-            print("Optimal Exercise at T = " + str(T) + ":", max(S_0_exercise_list))
-
-    ## Timestep 2
-    T = 5 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    #plot euro option
-    axs_2[1][1].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[1][1].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[1][1].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-        if option_type == "put":
-            print("Optimal Exercise at T = " + str(T) + ":", max(S_0_exercise_list))
-
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[1][1].text(0.25, .7,title_string,
-            transform=axs_2[1][1].transAxes, fontsize=10)
-
-    ## Timestep 3
-    T = 2 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    #plot euro option
-    axs_2[2][1].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[2][1].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[2][1].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-        if option_type == "put":
-            print("Optimal Exercise at T = " + str(T) + ":", max(S_0_exercise_list))
-
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[2][1].text(0.25, .7,title_string,
-            transform=axs_2[2][1].transAxes, fontsize=10)
-
-    
-
-    ## Timestep 4
-    T = 0 # to,e tp expiry
-    V_E_list = [] # European voption value
-
-    S_0_hold_list = []
-    V_A_hold_list = []
-    
-    S_0_exercise_list = []
-    V_A_exercise_list = []
-    
-    for S_0 in S_0_list:
-        euro_option_value = find_euro_option_value(S_0, r, sigma, T, steps, E, option_type)
-        amer_option_value, exercise = find_amer_option_value(S_0, r, sigma, T, steps, E, option_type)
-        V_E_list.append(euro_option_value)
-        if exercise:
-            V_A_exercise_list.append(amer_option_value)
-            S_0_exercise_list.append(S_0)
-        else:
-            V_A_hold_list.append(amer_option_value)
-            S_0_hold_list.append(S_0)
-    
-    #plot euro option
-    axs_2[3][1].plot(S_0_list, V_E_list, c='b', label="European Option")
-
-    # plot american option
-    axs_2[3][1].plot(S_0_hold_list, V_A_hold_list, c='r', label = "American Option (Held)")
-    if len(S_0_exercise_list)>0:
-        axs_2[3][1].plot(S_0_exercise_list, V_A_exercise_list, '--', c='r', label = "American Option (Exercised)")
-        if option_type == "put":
-            print("Optimal Exercise at T = " + str(T) + ":", max(S_0_exercise_list))
-
-    t_title = str(T)
-    title_string = "t = " + t_title
-    axs_2[3][1].text(0.25, .7,title_string,
-            transform=axs_2[3][1].transAxes, fontsize=10)
+    # Calls in the left column, puts in the right - one row per time to expiry
+    for col, option_type in enumerate(["call", "put"]): # types are "call", "put", "cash_or_nothing_call", "cash_or_nothing_put"
+        for row, T in enumerate([10, 5, 2, 0]): # time to expiry
+            # price every S_0 in one go
+            V_E, V_A, exercise = find_option_values_batch(S_0_list, r, sigma, T, steps, E, option_type)
+            plot_panel(axs_2[row][col], S_0_list, V_E, V_A, exercise, T, text_x=0.05 + 0.2*col)
+            if option_type == "put" and exercise.any():
+                print("Optimal Exercise at T = " + str(T) + ":", S_0_list[exercise].max())
     
     #####
 
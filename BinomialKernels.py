@@ -0,0 +1,85 @@
+# Compiled kernels for the American option pricer in "Binomial Method.py"
+# The backward induction visits every node of the tree, so it is compiled with numba.
+# The kernels are compiled just-in-time (and cached on disk) the first time they are called; price_all_amer runs on all cores.
+# Running this file compiles amer_backward and price_all_amer ahead-of-time into an extension module, binom_kernel:
+#     python BinomialKernels.py
+# binom_kernel does not need numba to run, so "Binomial Method.py" falls back to it on machines without numba.
+# (numba's AOT compiler does not support parallel=True, so the AOT price_all_amer runs on one core.)
+
+#----------------------------
+
+# import modules
+import numpy as np
+from numba import njit, prange, types
+
+# Option types are passed to the compiled code as integer codes rather than strings (OPTION_CODES in "Binomial Method.py"):
+# 0 - call, 1 - put, 2 - cash-or-nothing call, 3 - cash-or-nothing put
+
+# fastmath lets LLVM reorder the floating point adds/multiplies in the inner loops.
+
+# scalar version of the payoff function for use inside compiled code.
+@njit(cache=True, fastmath=True, boundscheck=False)
+def payoff_scalar(S, E, opt_code):
+    if opt_code == 0:
+        return max(S-E, 0.0)
+    elif opt_code == 1:
+        return max(E-S, 0.0)
+    elif opt_code == 2:
+        return 10.0*((S-E) > 0)
+    else:
+        return 10.0*((E-S) > 0)
+
+# work backwards through the tree from the payoffs at expiry, allowing early exercise at every node.
+# The stock price at node (i, 0) is S_0*dpow[i]; each step along a level (j -> j+1) multiplies it by u/d.
+@njit(cache=True, fastmath=True, boundscheck=False)
+def amer_backward(payoff_row, S_0, u, d, dpow, E, opt_code, discount, steps):
+    a = np.empty(steps+1)
+    a[:] = payoff_row
+    ratio = u/d
+    for i in range(steps-1, -1, -1):
+        S = S_0*dpow[i]
+        for j in range(i+1):
+            hold_value = discount*0.5*(a[j]+a[j+1])
+            exercise_value = payoff_scalar(S, E, opt_code)
+            a[j] = max(hold_value, exercise_value) # hold or exercise, whichever is worth more
+            S *= ratio
+    exercise = exercise_value > hold_value # the last node visited is the root - the decision at the current time
+    return a[0], exercise
+
+# American option values for a whole array of S_0, one independent backward induction per S_0.
+# prange spreads the S_0 values over all cores; each iteration owns its own scratch buffers.
+def _price_all_amer(S_0_arr, u, d, dpow, S_T_factor, E, opt_code, discount, steps):
+    K = S_0_arr.shape[0]
+    V_A = np.empty(K)
+    exercise = np.zeros(K, np.bool_)
+    for k in prange(K):
+        payoff_row = np.empty(steps+1)
+        for j in range(steps+1):
+            payoff_row[j] = payoff_scalar(S_0_arr[k]*S_T_factor[j], E, opt_code)
+        value, exercise_now = amer_backward(payoff_row, S_0_arr[k], u, d, dpow, E, opt_code, discount, steps)
+        V_A[k] = value
+        exercise[k] = exercise_now
+    return V_A, exercise
+
+price_all_amer = njit(parallel=True, cache=True, fastmath=True, boundscheck=False)(_price_all_amer)
+
+# (value, exercise) = amer_backward(payoff_row, S_0, u, d, dpow, E, opt_code, discount, steps)
+amer_backward_sig = types.Tuple((types.float64, types.boolean))(
+    types.float64[:], types.float64, types.float64, types.float64, types.float64[:],
+    types.float64, types.int64, types.float64, types.int64)
+
+# (V_A, exercise) = price_all_amer(S_0_arr, u, d, dpow, S_T_factor, E, opt_code, discount, steps)
+price_all_amer_sig = types.Tuple((types.float64[:], types.boolean[:]))(
+    types.float64[:], types.float64, types.float64, types.float64[:], types.float64[:],
+    types.float64, types.int64, types.float64, types.int64)
+
+
+## Build the ahead-of-time compiled extension
+# (numba's AOT compiler does not support parallel=True, so the compiled prange loop runs on one core)
+if __name__ == "__main__":
+    from numba.pycc import CC
+
+    cc = CC("binom_kernel")
+    cc.export("amer_backward", amer_backward_sig)(amer_backward.py_func)
+    cc.export("price_all_amer", price_all_amer_sig)(_price_all_amer)
+    cc.compile()
@@ -4,7 +4,9 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import norm
+from scipy.special import ndtr # standard normal cumulative distribution function
+from scipy.linalg import solve_banded
+from numba import njit, prange
 
 ### CALLS AND PUTS (ANALYTIC SOLUTIONS)
 # the value of a European call/put is a function of:
@@ -14,66 +16,56 @@ from scipy.stats import norm
 # sigma - stock volatility
 # E - Exercise price
 
+# S may be a single stock price or an array of them - the formulae broadcast over arrays.
+
+# d_1, d_2 and the discount factor exp(-r*t) are shared by calls and puts
+def find_d1_d2(S, t, r, sigma, E):
+    sigma_sqrt_t = sigma*np.sqrt(t)
+    d_1 = ((np.log(S/E)) + ((r + (sigma**2)/2)*t))/sigma_sqrt_t
+    d_2 = d_1 - sigma_sqrt_t
+    discount = np.exp(-r*t)
+    return d_1, d_2, discount
+
 # Analytic solution to European call
 def european_call(S, t, r, sigma, E):
-    d_1 = ((np.log(S/E)) + ((r + (sigma**2)/2)*t))/(sigma*np.sqrt(t))
-    d_2 = d_1 - (sigma*np.sqrt(t))
-    C_1 = norm.cdf(d_1)*S
-    C_2 = norm.cdf(d_2)*E*np.exp(-r*t)
+    d_1, d_2, discount = find_d1_d2(S, t, r, sigma, E)
+    C_1 = ndtr(d_1)*S
+    C_2 = ndtr(d_2)*E*discount
     C = C_1 - C_2    
     return C
 
 # Analytic solution to European put
 def european_put(S, t, r, sigma, E):
-    d_1 = ((np.log(S/E)) + ((r + (sigma**2)/2)*t))/(sigma*np.sqrt(t))
-    d_2 = d_1 - (sigma*np.sqrt(t))
-    P_1 = norm.cdf(-d_1)*S
-    P_2 = norm.cdf(-d_2)*E*np.exp(-r*t)
+    d_1, d_2, discount = find_d1_d2(S, t, r, sigma, E)
+    P_1 = ndtr(-d_1)*S
+    P_2 = ndtr(-d_2)*E*discount
     P = P_2 - P_1    
     return P
 
-# Make a plot of European call prices
-def make_call_plot(t, r, sigma, color_name):
-    S_list = np.linspace(50, 200)
-    C_list = []
+# Calls and puts together - the put follows from the call by put-call parity: P = C - S + E*exp(-r*t)
+def european_call_put(S, t, r, sigma, E):
+    d_1, d_2, discount = find_d1_d2(S, t, r, sigma, E)
+    C = ndtr(d_1)*S - ndtr(d_2)*E*discount
+    P = C - S + E*discount
+    return C, P
 
-    for S in S_list:
-        C = european_call(S, t, r, sigma, E)
-        C_list.append(C)
+# Make a plot of European option prices
+def make_price_plot(S_list, V_list, t, color_name):
     label_name = "T = " + str(t)
-    plt.plot(S_list, C_list, c=color_name, label=label_name)
-
-
-# Make a plot of European put prices
-def make_put_plot(t, r, sigma, color_name):
-    S_list = np.linspace(50, 200)
-    P_list = []
-
-    for S in S_list:
-        P = european_put(S, t, r, sigma, E)
-        P_list.append(P)
-    label_name = "T = " + str(t)
-    plt.plot(S_list, P_list, c=color_name, label=label_name)
+    plt.plot(S_list, V_list, c=color_name, label=label_name)
 
 #### OTHER EUROPEAN OPTIONS
 # For European options other than calls or puts, we can solve the Black-Scholes equation numerically
 # Define a payoff function
 
-# EXAMPLE: an option that pays out only if the stock expires in a certain window
-def payoff(S):
-    E = 110
-    B = 120
-    if S > B:
-        payoff = 0
-    elif S>E:
-        payoff = 10
-    else:
-        payoff = 0
-    return payoff
+# EXAMPLE: an option that pays out 10 only if the stock expires in a certain window, E < S <= B
+# S may be a single stock price or an array of them.
+def payoff_array(S, E=110, B=120):
+    return np.where((S > E) & (S <= B), 10.0, 0.0)
 
 # Now, construct a grid of points in the S, T plane
 # Rearranging BS, we obtain dVdt in terms of the other variables
-# dVdt = r*V - r*S*dVdS - 1/2*sigma**2*d2VdS2
+# dVdt = r*V - r*S*dVdS - 1/2*sigma**2*S**2*d2VdS2
 # A solution can then be found via the following steps:
 # 1. Calculate payoff at expiry V_expiry = payoff(S)
 # 2. Calculate LHS of equation above for this time.
@@ -81,114 +73,146 @@ def payoff(S):
 # 4. Step backwards a small amount in time.
 # 5. Repeat to desired time.
 
-# make some formulae to calculate derivatives
-def find_dVdS(V_list, S_list):
-    dVdS_list = []
-    for i in range(len(V_list)-1):
-        V_1 = V_list[i]
-        V_2 = V_list[i+1]
-        S_1 = S_list[i]
-        S_2 = S_list[i+1]
-        dVdS = (V_2-V_1)/(S_2-S_1)
-        dVdS_list.append(dVdS)
-    # we need to append a final value to maintain the length of dVdS
-    # linear interp
-    list_len = len(dVdS_list)
-    deltadVdS = (dVdS_list[list_len-1]-dVdS_list[list_len-2])
-    deltaS = (S_list[list_len-2] - S_list[list_len-3])
-    gradient = deltadVdS/deltaS
-    final_value = dVdS_list[list_len-1] + (S_list[-1] - S_list[-2])*gradient
-    dVdS_list.append(final_value)
-    return dVdS_list
-
-def find_d2VdS2(V_list, S_list):
-    d2VdS2_list = []
-    for i in range(1, len(V_list)-1):
-        V_minus = V_list[i-1]
-        V = V_list[i]
-        V_plus = V_list[i+1]
-        S_1 = S_list[i]
-        S_2 = S_list[i+1]
-        d2VdS2 = (V_minus-(2*V) + V_plus)/(S_2-S_1)
-        d2VdS2_list.append(d2VdS2)
-    # we need to append an initial and a final value to maintain the length of dVdS
-    # linear interp
-    list_len = len(d2VdS2_list)
-    # final value
-    deltad2VdS2 = (d2VdS2_list[list_len-1]-d2VdS2_list[list_len-2])
-    deltaS = (S_list[list_len-2] - S_list[list_len-3])
-    gradient = deltad2VdS2/deltaS
-    final_value = d2VdS2_list[list_len-1] + (S_list[-1] - S_list[-2])*gradient
-    d2VdS2_list.append(final_value)
-    
-    # initial value
-    deltad2VdS2 = (d2VdS2_list[1]-d2VdS2_list[0])
-    deltaS = (S_list[1] - S_list[0])
-    gradient = deltad2VdS2/deltaS
-    initial_value = d2VdS2_list[0] - (S_list[1] - S_list[0])*gradient
-    d2VdS2_list.insert(0, initial_value)
-    
-    return d2VdS2_list
-
-# Calculate the payoff at expiry for a range of tock prices
-def find_V_expiry(S_list, payoff):
-    V_expiry = []
-    for S in S_list:
-        V = payoff(S)
-        V_expiry.append(V)
-    return V_expiry
-
-# For a given list of V, S, r, sigma - calculate dVdt
-def find_dVdt(V_list, S_list, r, sigma):
-    dVdt_list = []
-    dVdS_list = find_dVdS(V_list, S_list)
-    d2VdS2_list = find_d2VdS2(V_list, S_list)
-    for i in range(len(V_list)):
-        V= V_list[i]
-        S = S_list[i]
-        dVdS = dVdS_list[i]
-        d2VdS2 = d2VdS2_list[i]
-        
-        dVdt = 0
-        dVdt += r*V
-        dVdt -= r*S*dVdS
-        dVdt -= 0.5*sigma*sigma*S*d2VdS2
-
-        dVdt_list.append(dVdt)
-
-    return dVdt_list
-    
-# construct a function that increments V a small amount (backwards)
-def update_V(V_list, dVdt_list, dt):
-    new_V_list = []
-    for i in range(len(V_list)):
-        V = V_list[i]
-        dVdt = dVdt_list[i]
-        dV = dVdt*dt
-        new_V = V - dV # we are iterating backwards
-        new_V_list.append(new_V)
-    return new_V_list
+# Calculate the payoff at expiry for a range of stock prices - the payoff function works on the whole array at once
+def find_V_expiry(S_list, payoff=payoff_array):
+    return payoff(np.asarray(S_list, dtype=float))
+
+# The time stepping is compiled with numba: each step is a loop over the S grid (run in parallel with prange).
+# Derivatives use finite differences (the grid need not be evenly spaced):
+#   dVdS at point i    = (V[i+1]-V[i])/(S[i+1]-S[i])
+#   d2VdS2 at point i  = 2*(dS[i-1]*V[i+1] - (dS[i-1]+dS[i])*V[i] + dS[i]*V[i-1])/(dS[i-1]*dS[i]*(dS[i-1]+dS[i])),
+#                        with dS[i] = S[i+1]-S[i] - on an even grid this is (V[i-1]-2*V[i]+V[i+1])/dS**2
+# At the end points (where a neighbour is missing) the derivatives are linearly extrapolated from the nearest values.
+# The explicit scheme is only stable for small time steps, roughly dt < dS**2/(sigma*S_max)**2.
+# The stepping alternates between two small buffers (which stay in cache); only every save_every-th step is
+# copied out into a row of V_data, shape (steps//save_every + 1, len(S)). steps must be a multiple of save_every.
+@njit(parallel=True, fastmath=True, cache=True)
+def solve_explicit(V_expiry, S, r, sigma, dt, steps, save_every):
+    if steps % save_every != 0:
+        raise ValueError("steps must be a multiple of save_every, so that the final step is saved")
+    N = S.shape[0]
+    n = N-1 # index of the last point
+    # the grid is the same at every step, so do the divisions once here and multiply inside the loop
+    dS = S[1:] - S[:-1]
+    inv_dS = 1.0/dS
+    # weights of V[i-1], V[i], V[i+1] in d2VdS2 at point i (the end points are not used)
+    w_lower = np.zeros(N)
+    w_mid = np.zeros(N)
+    w_upper = np.zeros(N)
+    for i in range(1, n):
+        scale = 2.0/(dS[i-1]*dS[i]*(dS[i-1]+dS[i]))
+        w_lower[i] = dS[i]*scale
+        w_mid[i] = -(dS[i-1]+dS[i])*scale
+        w_upper[i] = dS[i-1]*scale
+    ratio_0 = dS[0]/dS[1] # spacing ratios for the extrapolations at the end points
+    ratio_3 = dS[n-1]/dS[n-3]
+    ratio_n = dS[n-1]/dS[n-2]
+    V_data = np.empty((steps//save_every + 1, N))
+    V_data[0] = V_expiry
+    V = V_expiry.copy()
+    V_new = np.empty(N)
+    for step in range(steps):
+        # interior points
+        for i in prange(1, n):
+            dVdS = (V[i+1]-V[i])*inv_dS[i]
+            d2VdS2 = w_lower[i]*V[i-1] + w_mid[i]*V[i] + w_upper[i]*V[i+1]
+            dVdt = r*V[i] - r*S[i]*dVdS - 0.5*sigma*sigma*S[i]*S[i]*d2VdS2
+            V_new[i] = V[i] - dVdt*dt # we are iterating backwards
+
+        # initial point - d2VdS2 extrapolated from points 1 and 2
+        dVdS = (V[1]-V[0])*inv_dS[0]
+        d2VdS2_1 = w_lower[1]*V[0] + w_mid[1]*V[1] + w_upper[1]*V[2]
+        d2VdS2_2 = w_lower[2]*V[1] + w_mid[2]*V[2] + w_upper[2]*V[3]
+        d2VdS2 = d2VdS2_1 - (d2VdS2_2-d2VdS2_1)*ratio_0
+        dVdt = r*V[0] - r*S[0]*dVdS - 0.5*sigma*sigma*S[0]*S[0]*d2VdS2
+        V_new[0] = V[0] - dVdt*dt
+
+        # final point - both derivatives extrapolated from points n-1 and n-2
+        dVdS_1 = (V[n]-V[n-1])*inv_dS[n-1]
+        dVdS_2 = (V[n-1]-V[n-2])*inv_dS[n-2]
+        dVdS = dVdS_1 + (dVdS_1-dVdS_2)*ratio_3
+        d2VdS2_1 = w_lower[n-1]*V[n-2] + w_mid[n-1]*V[n-1] + w_upper[n-1]*V[n]
+        d2VdS2_2 = w_lower[n-2]*V[n-3] + w_mid[n-2]*V[n-2] + w_upper[n-2]*V[n-1]
+        d2VdS2 = d2VdS2_1 + (d2VdS2_1-d2VdS2_2)*ratio_n
+        dVdt = r*V[n] - r*S[n]*dVdS - 0.5*sigma*sigma*S[n]*S[n]*d2VdS2
+        V_new[n] = V[n] - dVdt*dt
+
+        V, V_new = V_new, V # swap buffers - V is now the latest step
+        if (step+1) % save_every == 0:
+            V_data[(step+1)//save_every] = V
+    return V_data
+
+# Crank-Nicolson: average the explicit and implicit steps. This is stable for any dt, so far fewer (larger) steps are needed.
+# On an evenly spaced S grid, with central differences, the right hand side of the rearranged equation is
+#   L V[i] = lower[i]*V[i-1] + diag[i]*V[i] + upper[i]*V[i+1]
+# and each step backwards solves (I - dt/2*L) V_new = (I + dt/2*L) V.
+# At the end points the option value is taken to be linear in S (d2VdS2 = 0): V[0] - 2*V[1] + V[2] = 0, and the same at the top.
+# This gives a banded matrix (two diagonals either side) which is constant, so it is built once and each step is one solve_banded call.
+# The first two steps are fully implicit (I - dt*L) V_new = V, which damps the oscillations that Crank-Nicolson
+# otherwise produces from a discontinuous payoff.
+def solve_crank_nicolson(V_expiry, S, r, sigma, dt, steps, save_every):
+    if steps % save_every != 0:
+        raise ValueError("steps must be a multiple of save_every, so that the final step is saved")
+    N = S.shape[0]
+    if not np.allclose(np.diff(S), S[1] - S[0]):
+        raise ValueError("Crank-Nicolson needs an evenly spaced S grid - use method='explicit' for an uneven grid")
+    inv_dS = 1.0/(S[1] - S[0])
+    a = 0.5*sigma**2*S**2*inv_dS**2
+    b = 0.5*r*S*inv_dS
+    lower = a - b
+    diag = -2*a - r
+    upper = a + b
+
+    # matrix (I - theta*dt*L) in the banded form used by solve_banded: row 2+i-j, column j holds element (i, j)
+    def make_banded(theta):
+        A = np.zeros((5, N))
+        A[1, 1:] = -theta*dt*upper[:-1]
+        A[2] = 1 - theta*dt*diag
+        A[3, :-1] = -theta*dt*lower[1:]
+        # end points - V[0] - 2*V[1] + V[2] = 0 and V[N-1] - 2*V[N-2] + V[N-3] = 0
+        A[2, 0], A[1, 1], A[0, 2] = 1, -2, 1
+        A[2, N-1], A[3, N-2], A[4, N-3] = 1, -2, 1
+        return A
+
+    A_cn = make_banded(0.5)
+    A_implicit = make_banded(1.0)
+    implicit_steps = 2
+
+    V_data = np.empty((steps//save_every + 1, N))
+    V_data[0] = V_expiry
+    V = np.array(V_expiry, dtype=float)
+    for step in range(steps):
+        if step < implicit_steps:
+            rhs = V.copy()
+            A = A_implicit
+        else:
+            LV = diag*V
+            LV[1:] += lower[1:]*V[:-1]
+            LV[:-1] += upper[:-1]*V[1:]
+            rhs = V + 0.5*dt*LV
+            A = A_cn
+        rhs[0] = 0
+        rhs[-1] = 0
+        V = solve_banded((2, 2), A, rhs)
+        if (step+1) % save_every == 0:
+            V_data[(step+1)//save_every] = V
+    return V_data
 
 # Now put it all together - for n steps for size dt
-def find_option_value(S_list, r, sigma, steps, dt):
-    V_expiry = find_V_expiry(S_list, payoff)
-    
-    V_data = [V_expiry]
-    t_list = [0.0]
-    
-    V_now = V_expiry
-    t_now = 0.0
-    for i in range(steps):
-        dVdt_list = find_dVdt(V_now, S_list, r, sigma)
-        V_new = update_V(V_now, dVdt_list, dt)
-        t_new = t_now + dt
-
-        V_data.append(V_new)
-        t_list.append(t_new)
-
-        V_now = V_new
-        t_now = t_new
-    
+# V_data[k] is the option value at time k*save_every*dt before expiry (save_every=1 keeps every step;
+# steps must be a multiple of save_every, so the last row is always the final step).
+# method is "crank_nicolson" (S_list must be evenly spaced) or "explicit" (needs a small dt to stay stable).
+# Both solve the same equation, so they agree (up to discretisation error) when both are stable.
+PDE_SOLVERS = {
+    "crank_nicolson": solve_crank_nicolson,
+    "explicit": solve_explicit,
+}
+
+def find_option_value(S_list, r, sigma, steps, dt, save_every=1, method="crank_nicolson"):
+    S = np.asarray(S_list, dtype=float)
+    V_expiry = find_V_expiry(S)
+    V_data = PDE_SOLVERS[method](V_expiry, S, r, sigma, dt, steps, save_every)
+    t_list = save_every*dt*np.arange(V_data.shape[0])
     return V_data, t_list
 
 
@@ -203,6 +227,18 @@ if __name__ == "__main__":
     sigma = 0.1 # volatility
     E = 120 # strike price
 
+    # price calls and puts for a few times-to-expiry in one pass
+    S_list = np.linspace(50, 200)
+    t_values = [1.00, 0.50, 0.01]
+    color_names = ['blue', 'red', 'green']
+
+    C_data = []
+    P_data = []
+    for t in t_values:
+        C_list, P_list = european_call_put(S_list, t, r, sigma, E)
+        C_data.append(C_list)
+        P_data.append(P_list)
+
     ### European Calls ###
     # make a few plots at different times-to-expiy
     fig_1, axs_1 = plt.subplots(1, 1)
@@ -213,18 +249,8 @@ if __name__ == "__main__":
     subtitle_string = r"$r = $" + str(r) + r", $\sigma = $" + str(sigma) + r", $E = $" + str(E)
     axs_1.set_title(subtitle_string)
     
-
-    t = 1.00
-    color_name = 'blue'
-    make_call_plot(t, r, sigma, color_name)
-        
-    t = 0.50
-    color_name = 'red'
-    make_call_plot(t, r, sigma, color_name)
-        
-    t = 0.01
-    color_name = 'green'
-    make_call_plot(t, r, sigma, color_name)
+    for t, C_list, color_name in zip(t_values, C_data, color_names):
+        make_price_plot(S_list, C_list, t, color_name)
 
     plt.xlabel("Stock Price")
     plt.ylabel("Option Price")
@@ -243,17 +269,8 @@ if __name__ == "__main__":
     subtitle_string = r"$r = $" + str(r) + r", $\sigma = $" + str(sigma) + r", $E = $" + str(E)
     axs_2.set_title(subtitle_string)
     
-    t = 1.00
-    color_name = 'blue'
-    make_put_plot(t, r, sigma, color_name)
-        
-    t = 0.50
-    color_name = 'red'
-    make_put_plot(t, r, sigma, color_name)
-        
-    t = 0.01
-    color_name = 'green'
-    make_put_plot(t, r, sigma, color_name)
+    for t, P_list, color_name in zip(t_values, P_data, color_names):
+        make_price_plot(S_list, P_list, t, color_name)
     
     
     plt.xlabel("Stock Price")
@@ -268,11 +285,13 @@ if __name__ == "__main__":
     sigma = 0.1 # volatility
 
     # Algorithm parameters
-    S_list = np.linspace(50, 150, 400)
-    dt = 0.01
-    steps = 1000
+    # the grid extends well beyond the plotted range, so the end point condition does not disturb the plotted values
+    S_list = np.linspace(0, 300, 1201)
+    dt = 0.1 # Crank-Nicolson is stable for large time steps
+    steps = 100
+    save_every = 10 # keep one time slice in every 10 steps
 
-    V_data, t_list = find_option_value(S_list, r, sigma, steps, dt)
+    V_data, t_list = find_option_value(S_list, r, sigma, steps, dt, save_every)
 
     index = 0
     V_list = V_data[index]
@@ -283,7 +302,7 @@ if __name__ == "__main__":
     plt.plot(S_list, V_list, label=label_name)
 
     
-    index = 300
+    index = 3
     V_list = V_data[index]
     t = t_list[index]
     
@@ -292,7 +311,7 @@ if __name__ == "__main__":
     plt.plot(S_list, V_list, label=label_name)
 
     
-    index = 600
+    index = 6
     V_list = V_data[index]
     t = t_list[index]
     
@@ -300,9 +319,10 @@ if __name__ == "__main__":
     label_name = "t = " + t_title    
     plt.plot(S_list, V_list, label=label_name)
     
-    title_string = "The value of a European option that pays out 10 if the stock price expires between 120 and 150 - r = " + str(r) + r", $\sigma = $" + str(sigma) 
+    title_string = "The value of a European option that pays out 10 if the stock price expires between 110 and 120 - r = " + str(r) + r", $\sigma = $" + str(sigma) 
     plt.title(title_string)
     
+    plt.xlim(50, 150)
     plt.xlabel("Stock Price")
     plt.ylabel("Option Value")
 
@@ -7,55 +7,46 @@
 # import modules
 import numpy as np
 import matplotlib.pyplot as plt
-import math
 
-# given S_0, r, sigma, time horizon and steps, generate a stock price simulation
-# based on geometric Brownian motion
+# one random number generator (PCG64) shared by all simulations
+rng = np.random.default_rng()
 
-def find_stock_price(S_0, r, sigma, T, steps):
+# generate many stock price simulations at once - one row per simulation (trial)
+# uses the exact solution of geometric Brownian motion, S(t+dt) = S(t)*exp((r - sigma^2/2)*dt + sigma*sqrt(dt)*Z),
+# so every path is built from one block of random numbers and a cumulative sum - no loop over time steps.
+# (This is the same lognormal distribution as the analytic result p_func below, with no time-step bias.)
+def simulate_paths(S_0, r, sigma, T, steps, trials):
     # find timestep
     dt = T/steps
     
-    # initialise lists
-    S = [S_0]
-    t = [0.0]
-    
-    S_now = S_0
-    t_now = 0.0
-    
-    # perform simulation
-    for i in range(steps):
-        drift = r*S_now*dt # drift component
-        vol = sigma*S_now*np.random.normal(0, np.sqrt(dt)) # random walk component
-        dS = drift + vol # total change
-        
-        # updae current values
-        S_now += dS
-        t_now += dt
-        
-        # update lists
-        S.append(S_now)
-        t.append(t_now)
+    Z = rng.standard_normal((trials, steps))
+    log_increments = (r - 0.5*sigma*sigma)*dt + sigma*np.sqrt(dt)*Z
     
+    S = np.empty((trials, steps+1))
+    S[:, 0] = S_0
+    S[:, 1:] = S_0*np.exp(np.cumsum(log_increments, axis=1))
+    t = dt*np.arange(steps+1)
     return S, t
 
+# given S_0, r, sigma, time horizon and steps, generate a stock price simulation
+# based on geometric brownian motion
+def find_stock_price(S_0, r, sigma, T, steps):
+    S, t = simulate_paths(S_0, r, sigma, T, steps, 1)
+    return S[0], t
+
 # get analytic solution for probability density
 # based on the results derived from Ito calculus - continuous random walk of geometric brownian motion
 
-# the probability density function
+# the probability density function - S may be a single stock price or an array of them
 def p_func(S, S_0, r, sigma, t):
     factor = 1/(sigma*S*np.sqrt(2*np.pi*t))
     exponent = -( (np.log(S/S_0) - ((r-0.5*sigma*sigma)*t))**2 )/(2*sigma*sigma*t)
     p = factor*np.exp(exponent)
     return p
     
-# evaluating the probability density function of a specified range of values
+# evaluating the probability density function of a specified range of values (all at once)
 def analytic_stock_prob(S_range, S_0, r, sigma, t):
-    p = []
-    for S in S_range:
-        p_value = p_func(S, S_0, r, sigma, t)
-        p.append(p_value)
-    return p
+    return p_func(np.asarray(S_range), S_0, r, sigma, t)
 
 ## Main program - simulate results and analyse
 if __name__ == "__main__":    
@@ -73,45 +64,13 @@ if __name__ == "__main__":
     # (It's faster to do this as the simulations are produced, but could be done after)
     index_list = [10, 30, 60, 90]
     
-    # initialise list to collect results
-    S_data = []
-    
-    # run simulation
-    for i in range(trials):
-        S, t = find_stock_price(S_0, r, sigma, T, steps)
-        S_data.append(S) # record results
-    
-    # calculate deciles, quartiles and medians
-    # the position in the sorted results at which they occur
-    d_1_index = int(math.floor(trials/10))
-    q_1_index = int(math.floor(trials/4))
-    m_index = int(math.floor(2*trials/4))
-    q_3_index = int(math.floor(3*trials/4))
-    d_9_index = int(math.floor(9*trials/10))
-    
-    # initialise lists
-    d_1 = [S_0]
-    q_1 = [S_0]
-    median = [S_0]
-    q_3 = [S_0]
-    d_9 = [S_0]
-    
-    # find all simulation values at a specific time
-    # sort the results
-    # record the deciles, quartiles and median
-    for i in range(steps):
-        time_list = []
-        for j in range(trials):
-            S = S_data[j]
-            time_value = S[i]
-            time_list.append(time_value)
-        time_list.sort() # sort results
-        d_1.append(time_list[d_1_index])
-        q_1.append(time_list[q_1_index])
-        median.append(time_list[m_index])
-        q_3.append(time_list[q_3_index])
-        d_9.append(time_list[d_9_index])
-        
+    # run all the simulations at once
+    # one row per simulation, one column per time step
+    S_data, t = simulate_paths(S_0, r, sigma, T, steps, trials)
+    
+    # calculate deciles, quartiles and medians at every time step - take the quantiles down each column
+    # (np.quantile picks out the order statistics with a partial sort, np.partition, rather than sorting each column)
+    d_1, q_1, median, q_3, d_9 = np.quantile(S_data, [0.1, 0.25, 0.5, 0.75, 0.9], axis=0)
     
     #####################
     ### Figure 1 ###
@@ -167,10 +126,8 @@ if __name__ == "__main__":
         index = index_list[i]
         t_index = t[index]
         
-        # simulation results
-        S_exp_index = []
-        for j in range(trials):
-            S_exp_index.append(S_data[j][index])
+        # simulation results - every simulation at this time step
+        S_exp_index = S_data[:, index]
         
         # analytic results
         p = analytic_stock_prob(S_range, S_0, r, sigma, t_index)
@@ -5,36 +5,208 @@
 from re import A
 import numpy as np
 import matplotlib.pyplot as plt
-from GeomStockPrice import find_stock_price # a function that produces a random stock price
+from scipy.special import ndtr # standard normal cumulative distribution function
+from numba import njit, prange
 
 # define the payoff for some exotic function
 # try a path-dependent functio
 # an 'Asian' option has a payoff that is determined by its average value between issue and expiry
-
-# define a function to calculate the average - different options use different definitions of 'average' - we will stick with arithmetic average
-# we will assume an equal time step in the data
-def find_average(S):
-    avg_S = np.mean(S)
-    return avg_S
-
-# an Asian call has a price at expiry equal to the maximum of either the average-strike or zero.
-def asian_call_payoff(S, E):
-    avg_S = find_average(S)
-    if avg_S>E:
-        payoff = avg_S-E
-    else:
-        payoff = 0
-    return payoff
+# different options use different definitions of 'average' - we will stick with arithmetic average, with an equal time step.
+# an Asian call has a price at expiry equal to the maximum of either the average-strike or zero: max(mean(S) - E, 0)
 
 # Another exotic option - the 'lookback' option - an option to buy the stock at the highest price
-# in the time interval
-def lookback_call_payoff(S, E):
-    max_S = max(S)
-    if max_S>E:
-        payoff = max_S-E
-    else:
-        payoff = 0
-    return payoff
+# in the time interval: max(max(S) - E, 0)
+
+# Both payoffs are evaluated inside the compiled simulation kernels below, from the running average/maximum of each path.
+
+
+# The pricing loops are compiled with numba. Every trial is an independent path, so the trials run in parallel (prange);
+# numba's random number generator keeps a separate stream for each thread.
+# Each path is stepped with the exact geometric Brownian motion update, S -> S*exp((r - sigma^2/2)*dt + sigma*sqrt(dt)*Z),
+# keeping only the running average/maximum rather than the whole path.
+# A path to the longest expiry passes through every shorter one, so all the expiries in T_arr are priced from the same paths:
+# the paths take steps steps of dt = max(T_arr)/steps, and the expiry T is read off after round(T/dt) of them
+# (so steps must be chosen to make every T a whole number of steps - otherwise ValueError is raised).
+# E stays an ordinary argument: the payoff is evaluated once per path (not per step), so compiling E in as a constant
+# gains nothing, and kernels built from closures could not use numba's on-disk cache.
+
+# Two tricks reduce the number of trials needed for a given error:
+# 1. Antithetic variates - the trials are run in pairs, one path driven by Z and its mirror image by -Z.
+#    The average payoff of the pair varies much less than the payoff of a single path.
+# 2. A control variate (Asian call only) - the same option on the geometric average of the path has an exact price.
+#    The geometric payoff moves closely with the arithmetic one, so the error in its simulated mean is used to correct
+#    the arithmetic estimate: price = mean(A) - beta*(mean(G) - exact G), with beta = cov(A, G)/var(G) from the same samples.
+
+# The payoffs are not stored: the trials are split into MC_BLOCKS blocks (shared out between the threads), each block
+# keeps running means, sums of squared deviations and the co-moment of the samples x, y (Welford's method),
+# and the blocks are combined at the end.
+MC_BLOCKS = 64 # enough blocks to keep every core busy
+
+# the number of steps to reach each expiry, and the matching discount factors
+@njit(cache=True)
+def find_expiry_steps(r, T_arr, steps):
+    dt = T_arr.max()/steps
+    k_T = np.empty(T_arr.shape[0], np.int64)
+    for m in range(T_arr.shape[0]):
+        k_T[m] = 0 if dt == 0 else int(np.rint(T_arr[m]/dt))
+        if dt != 0 and abs(T_arr[m]/dt - k_T[m]) > 1e-9:
+            raise ValueError("every expiry in T_arr must be a whole number of time steps, max(T_arr)/steps")
+    discount = np.exp(-r*dt*k_T)
+    return dt, k_T, discount
+
+# add the count-th pair of values (x, y) for expiry m to the running statistics (Welford's method)
+# stats rows: mean of x, mean of y, M2 of x, M2 of y, co-moment of x and y
+@njit(cache=True, fastmath=True)
+def add_sample(stats, m, count, x, y):
+    delta_x = x - stats[0, m]
+    delta_y = y - stats[1, m]
+    stats[0, m] += delta_x/count
+    stats[1, m] += delta_y/count
+    stats[2, m] += delta_x*(x - stats[0, m])
+    stats[3, m] += delta_y*(y - stats[1, m])
+    stats[4, m] += delta_x*(y - stats[1, m])
+
+# combine the statistics of each block of samples (one per block) - returns the number of samples,
+# and the means, (sample) variances and covariance of x and y. At least two samples are needed for a variance.
+@njit(cache=True)
+def combine_blocks(counts, stats):
+    if counts.sum() < 2:
+        raise ValueError("at least two samples are needed to estimate a variance")
+    total = np.zeros(stats.shape[1:])
+    n = 0
+    for c in range(counts.shape[0]):
+        if counts[c] == 0: # an empty block adds nothing
+            continue
+        n_new = n + counts[c]
+        delta_x = stats[c, 0] - total[0]
+        delta_y = stats[c, 1] - total[1]
+        weight = n*counts[c]/n_new
+        total[0] += delta_x*counts[c]/n_new
+        total[1] += delta_y*counts[c]/n_new
+        total[2] += stats[c, 2] + delta_x*delta_x*weight
+        total[3] += stats[c, 3] + delta_y*delta_y*weight
+        total[4] += stats[c, 4] + delta_x*delta_y*weight
+        n = n_new
+    total[2:] /= n-1
+    return n, total
+
+# Asian call samples - x is the arithmetic average payoff, y is the geometric average payoff,
+# each averaged over an antithetic pair of paths (averages include S_0)
+@njit(parallel=True, fastmath=True, cache=True)
+def simulate_asian(S_0, r, sigma, T_arr, steps, pairs, E):
+    dt, k_T, discount = find_expiry_steps(r, T_arr, steps)
+    drift = (r - 0.5*sigma*sigma)*dt
+    vol = sigma*np.sqrt(dt)
+    growth_pair = np.exp(2*drift) # the product of the two growth factors, so the mirror path needs no extra exp
+    n_T = T_arr.shape[0]
+    blocks = min(pairs, MC_BLOCKS)
+    counts = np.zeros(blocks, np.int64)
+    stats = np.zeros((blocks, 5, n_T))
+    for c in prange(blocks):
+        for i in range(c*pairs//blocks, (c+1)*pairs//blocks):
+            counts[c] += 1
+            S_1 = S_0
+            S_2 = S_0
+            total_S_1 = S_0
+            total_S_2 = S_0
+            log_S_1 = 0.0 # log(S/S_0)
+            log_S_2 = 0.0
+            total_log_1 = 0.0
+            total_log_2 = 0.0
+            for k in range(steps+1):
+                if k > 0:
+                    Z = np.random.standard_normal()
+                    growth = np.exp(drift + vol*Z)
+                    S_1 *= growth
+                    S_2 *= growth_pair/growth # driven by -Z
+                    total_S_1 += S_1
+                    total_S_2 += S_2
+                    log_S_1 += drift + vol*Z
+                    log_S_2 += drift - vol*Z
+                    total_log_1 += log_S_1
+                    total_log_2 += log_S_2
+                for m in range(n_T):
+                    if k_T[m] == k:
+                        arith = max(total_S_1/(k+1)-E, 0.0) + max(total_S_2/(k+1)-E, 0.0)
+                        geom = max(S_0*np.exp(total_log_1/(k+1))-E, 0.0) + max(S_0*np.exp(total_log_2/(k+1))-E, 0.0)
+                        add_sample(stats[c], m, counts[c], 0.5*arith*discount[m], 0.5*geom*discount[m])
+    return combine_blocks(counts, stats)
+
+# lookback call samples - x is the payoff on the maximum of the path,
+# averaged over an antithetic pair of paths (there is no control variate, y is 0)
+@njit(parallel=True, fastmath=True, cache=True)
+def simulate_lookback(S_0, r, sigma, T_arr, steps, pairs, E):
+    dt, k_T, discount = find_expiry_steps(r, T_arr, steps)
+    drift = (r - 0.5*sigma*sigma)*dt
+    vol = sigma*np.sqrt(dt)
+    growth_pair = np.exp(2*drift)
+    n_T = T_arr.shape[0]
+    blocks = min(pairs, MC_BLOCKS)
+    counts = np.zeros(blocks, np.int64)
+    stats = np.zeros((blocks, 5, n_T))
+    for c in prange(blocks):
+        for i in range(c*pairs//blocks, (c+1)*pairs//blocks):
+            counts[c] += 1
+            S_1 = S_0
+            S_2 = S_0
+            max_S_1 = S_0
+            max_S_2 = S_0
+            for k in range(steps+1):
+                if k > 0:
+                    growth = np.exp(drift + vol*np.random.standard_normal())
+                    S_1 *= growth
+                    S_2 *= growth_pair/growth
+                    max_S_1 = max(max_S_1, S_1)
+                    max_S_2 = max(max_S_2, S_2)
+                for m in range(n_T):
+                    if k_T[m] == k:
+                        payoff = max(max_S_1-E, 0.0) + max(max_S_2-E, 0.0)
+                        add_sample(stats[c], m, counts[c], 0.5*payoff*discount[m], 0.0)
+    return combine_blocks(counts, stats)
+
+# Exact price of an Asian call on the geometric average of S_0, S_1, ..., S_k (k steps of dt) - the control variate.
+# log(G/S_0) is normally distributed with mean (r - sigma^2/2)*dt*k/2 and variance sigma^2*dt*k*(2k+1)/(6*(k+1)).
+def geometric_asian_call(S_0, r, sigma, dt, k, E):
+    k = np.asarray(k, dtype=float)
+    mean_log_G = np.log(S_0) + (r - 0.5*sigma*sigma)*dt*k/2
+    var_log_G = sigma*sigma*dt*k*(2*k+1)/(6*(k+1))
+    discount = np.exp(-r*dt*k)
+    sqrt_var = np.sqrt(var_log_G)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_1 = (mean_log_G - np.log(E) + var_log_G)/sqrt_var
+        d_2 = d_1 - sqrt_var
+        price = discount*(np.exp(mean_log_G + 0.5*var_log_G)*ndtr(d_1) - E*ndtr(d_2))
+    # at k = 0 there is no randomness - the payoff is known
+    return np.where(var_log_G > 0, price, discount*np.maximum(np.exp(mean_log_G)-E, 0.0))
+
+# the number of antithetic pairs to simulate for a given number of trials (paths).
+# An odd number of trials is rounded down to an even one. At least min_pairs pairs are needed for a standard error:
+# two for a plain mean, three when a control variate's beta is also fitted to the same samples.
+def find_pairs(trials, min_pairs=2):
+    if trials//2 < min_pairs:
+        raise ValueError("trials must be at least " + str(2*min_pairs) + " (" + str(min_pairs) + " antithetic pairs) to estimate the standard error")
+    return trials//2
+
+# Asian call price for every expiry in T_arr, and the standard error of each estimate.
+# trials paths are simulated, as trials//2 antithetic pairs (an odd number of trials is rounded down; trials >= 6).
+def mc_asian(S_0, r, sigma, T_arr, steps, trials, E):
+    n, total = simulate_asian(S_0, r, sigma, T_arr, steps, find_pairs(trials, min_pairs=3), E)
+    mean_A, mean_G, var_A, var_G, cov_AG = total
+    dt, k_T, discount = find_expiry_steps(r, T_arr, steps)
+    exact_G = geometric_asian_call(S_0, r, sigma, dt, k_T, E)
+    fitted = var_G > 0
+    beta = np.divide(cov_AG, var_G, out=np.zeros_like(cov_AG), where=fitted)
+    price = mean_A - beta*(mean_G - exact_G)
+    # variance left after the correction - fitting beta uses up another degree of freedom, so n-2 rather than n-1
+    dof_factor = np.where(fitted, (n-1)/(n-2), 1.0)
+    var_price = np.maximum(var_A - beta*cov_AG, 0.0)*dof_factor
+    return price, np.sqrt(var_price/n)
+
+# lookback call price for every expiry in T_arr, and the standard error of each estimate.
+# trials paths are simulated, as trials//2 antithetic pairs (an odd number of trials is rounded down; trials >= 4).
+def mc_lookback(S_0, r, sigma, T_arr, steps, trials, E):
+    n, total = simulate_lookback(S_0, r, sigma, T_arr, steps, find_pairs(trials), E)
+    return total[0], np.sqrt(total[2]/n)
 
 
 # let's run a few tests
@@ -44,34 +216,30 @@ if __name__ == "__main__":
 
     r = 0.1
     sigma = 0.1
-    steps = 25
+    steps = 50 # to T = 10, so dt = 0.2 and every expiry below is a whole number of steps
     trials = 500
-    sqrt_trials = np.sqrt(trials)
 
     E = 130
     S_0_list = np.linspace(0.01, 200, 10)
 
-    def make_asian_call_plot(S_0_list, T, color_name, r, sigma, steps, E):
-        mean_asian_price = []
-        err_asian_price = []
-        discount = np.exp(-r*T)
-        for S_0 in S_0_list:
-            asian_price = []
-            for i in range(trials):
-                S, t = find_stock_price(S_0, r, sigma, T, steps)
-                asian_call_at_expiry = asian_call_payoff(S,E)
-                asian_price.append(asian_call_at_expiry*discount)
-            mean_price = np.mean(asian_price)
-            err_price = 1.96*np.std(asian_price)/sqrt_trials
-            mean_asian_price.append(mean_price)
-            err_asian_price.append(err_price)
+    # price every expiry from the same set of paths, then plot one line per expiry
+    def make_asian_call_plots(S_0_list, T_list, color_names, r, sigma, steps, E):
+        T_arr = np.asarray(T_list, dtype=float)
+        mean_asian_price = np.empty((len(S_0_list), len(T_list)))
+        err_asian_price = np.empty((len(S_0_list), len(T_list)))
+        for n, S_0 in enumerate(S_0_list):
+            # all trials at once, in parallel
+            mean_price, std_err = mc_asian(S_0, r, sigma, T_arr, steps, trials, E)
+            mean_asian_price[n] = mean_price
+            err_asian_price[n] = 1.96*std_err
             print(S_0)
 
-        plt.errorbar(S_0_list, mean_asian_price, yerr=err_asian_price, fmt='none',
-        color=color_name, capsize=5, elinewidth=2, markeredgewidth=2)
+        for m, (T, color_name) in enumerate(zip(T_list, color_names)):
+            plt.errorbar(S_0_list, mean_asian_price[:, m], yerr=err_asian_price[:, m], fmt='none',
+            color=color_name, capsize=5, elinewidth=2, markeredgewidth=2)
 
-        label_name = "T = " + str(T)
-        plt.plot(S_0_list, mean_asian_price, c=color_name, label=label_name)
+            label_name = "T = " + str(T)
+            plt.plot(S_0_list, mean_asian_price[:, m], c=color_name, label=label_name)
     
     fig, ax = plt.subplots(1,1)
 
@@ -82,22 +250,10 @@ if __name__ == "__main__":
     ax.set_xlabel("Stock Price")
     ax.set_ylabel("Option Price")
     
-
-    T = 10.0
-    color_name = "black"
-    make_asian_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
-    
-    T = 5.0
-    color_name = "blue"
-    make_asian_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
-
-    T = 2.0
-    color_name = "red"
-    make_asian_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
-
-    T = 0.0
-    color_name = "green"
-    make_asian_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
+    # steps is the number of time steps to the longest expiry
+    T_list = [10.0, 5.0, 2.0, 0.0]
+    color_names = ["black", "blue", "red", "green"]
+    make_asian_call_plots(S_0_list, T_list, color_names, r, sigma, steps, E)
 
     ax.legend()
 
@@ -108,34 +264,30 @@ if __name__ == "__main__":
 
     r = 0.03
     sigma = 0.2
-    steps = 1000
+    steps = 1000 # to T = 10, dt = 0.01
     trials = 1000
-    sqrt_trials = np.sqrt(trials)
 
     E = 130
     S_0_list = np.linspace(0.01, 200, 10)
 
-    def make_lookback_call_plot(S_0_list, T, color_name, r, sigma, steps, E):
-        mean_lookback_price = []
-        err_lookback_price = []
-        discount = np.exp(-r*T)
-        for S_0 in S_0_list:
-            lookback_price = []
-            for i in range(trials):
-                S, t = find_stock_price(S_0, r, sigma, T, steps)
-                lookback_call_at_expiry = lookback_call_payoff(S,E)
-                lookback_price.append(lookback_call_at_expiry*discount)
-            mean_price = np.mean(lookback_price)
-            err_price = 1.96*np.std(lookback_price)/sqrt_trials
-            mean_lookback_price.append(mean_price)
-            err_lookback_price.append(err_price)
+    # price every expiry from the same set of paths, then plot one line per expiry
+    def make_lookback_call_plots(S_0_list, T_list, color_names, r, sigma, steps, E):
+        T_arr = np.asarray(T_list, dtype=float)
+        mean_lookback_price = np.empty((len(S_0_list), len(T_list)))
+        err_lookback_price = np.empty((len(S_0_list), len(T_list)))
+        for n, S_0 in enumerate(S_0_list):
+            # all trials at once, in parallel
+            mean_price, std_err = mc_lookback(S_0, r, sigma, T_arr, steps, trials, E)
+            mean_lookback_price[n] = mean_price
+            err_lookback_price[n] = 1.96*std_err
             print(S_0)
 
-        plt.errorbar(S_0_list, mean_lookback_price, yerr=err_lookback_price, fmt='none',
-        color=color_name, capsize=5, elinewidth=2, markeredgewidth=2)
+        for m, (T, color_name) in enumerate(zip(T_list, color_names)):
+            plt.errorbar(S_0_list, mean_lookback_price[:, m], yerr=err_lookback_price[:, m], fmt='none',
+            color=color_name, capsize=5, elinewidth=2, markeredgewidth=2)
 
-        label_name = "T = " + str(T)
-        plt.plot(S_0_list, mean_lookback_price, c=color_name, label=label_name)
+            label_name = "T = " + str(T)
+            plt.plot(S_0_list, mean_lookback_price[:, m], c=color_name, label=label_name)
     
     fig_new, ax_new = plt.subplots(1,1)
 
@@ -146,21 +298,10 @@ if __name__ == "__main__":
     ax_new.set_xlabel("Stock Price")
     ax_new.set_ylabel("Option Price")
     
-    T = 10.0
-    color_name = "black"
-    make_lookback_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
-    
-    T = 5.0
-    color_name = "blue"
-    make_lookback_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
-    
-    T = 2.0
-    color_name = "red"
-    make_lookback_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
-    
-    T = 1.0
-    color_name = "green"
-    make_lookback_call_plot(S_0_list, T, color_name, r, sigma, steps, E)
+    # steps is the number of time steps to the longest expiry
+    T_list = [10.0, 5.0, 2.0, 1.0]
+    color_names = ["black", "blue", "red", "green"]
+    make_lookback_call_plots(S_0_list, T_list, color_names, r, sigma, steps, E)
 
     ax_new.legend()
     